@@ -1,12 +1,53 @@
 import os
+import collections
+import functools
+import json
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 import re
+import struct
 import time
 
+# libjpeg-turbo (via PyTurboJPEG) is optional; without it OpenCV does all the decoding/encoding
+try:
+    from turbojpeg import TurboJPEG, TJPF_GRAY, TJSAMP_GRAY
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+
+JPEG_QUALITY = 90
+
+# Every JPEG starts with an SOI marker followed by another marker
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+# Wider images are downsized to this width, keeping the aspect ratio
+MAX_WIDTH = 4000
+
+# How many input files are read ahead of the workers, and how many threads write outputs
+PREFETCH_DEPTH = 4
+WRITER_THREADS = 2
+
+# The threshold mean is taken over every Nth pixel in each direction
+MEAN_SAMPLE_STRIDE = 8
+
+# Runs of spaces/hyphens that normalize_filename() collapses to a single underscore
+FILENAME_SEPARATOR_RE = re.compile(r'[\s\-]+')
+
+# Normalized filename prefix => (id_type, threshold offset below the mean)
+ID_TYPES = {
+    "license": ("drivers_license", 20),
+    "passport": ("passport", 30),
+}
+
+# Written next to the preprocessed images; maps each output filename to its id_type
+MANIFEST_FILENAME = "manifest.json"
+
 # -------------------------------
 # 🔹 UTILITY: NORMALIZE FILENAME
 # -------------------------------
+@functools.lru_cache(maxsize=4096)
 def normalize_filename(filename):
     """
     Normalizes a filename by:
@@ -15,62 +56,248 @@ def normalize_filename(filename):
       - Replacing spaces and hyphens with underscores
     """
     name, _ = os.path.splitext(filename)
-    return re.sub(r'[\s\-]+', '_', name.lower())
+    return FILENAME_SEPARATOR_RE.sub('_', name.lower())
+
+
+def classify_id(normalized_name):
+    """
+    Returns (id_type, offset) for a normalized filename, based on its prefix:
+      - license  => drivers_license, mean - 20
+      - passport => passport, mean - 30
+      - otherwise => N/A, offset = 0 (just use mean)
+    """
+    for prefix, id_info in ID_TYPES.items():
+        if normalized_name.startswith(prefix):
+            return id_info
+    return "N/A", 0
 
 
 # -----------------------------
-# 🔹 IMAGE PREPROCESSING
+# 🔹 FILE I/O
 # -----------------------------
-def resize_image(image, max_width=4000):
+def read_file(path):
     """
-    Resizes image while maintaining aspect ratio (max width = 4000px).
+    Reads a whole file into memory and returns its bytes.
     """
-    h, w = image.shape[:2]
-    if w > max_width:
-        ratio = max_width / w
-        new_size = (int(w * ratio), int(h * ratio))
-        image = cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
-    return image
+    with open(path, "rb") as f:
+        return f.read()
 
 
-def preprocess_image(image_path, offset):
+def write_file(path, data):
     """
-    1) Reads the image
-    2) Resizes if necessary (max width = 4000)
-    3) Converts to grayscale
-    4) Calculates (mean - offset) for threshold
-    5) Binarizes the image
-    6) Returns (final_image, final_size_bytes, local_time).
+    Writes a bytes-like buffer to path.
     """
-    start_local = time.perf_counter()
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def prefetch(executor, fn, items, depth):
+    """
+    Yields fn(item) for each item, in order, while keeping up to `depth`
+    calls running ahead on the executor.
+    (2_text_extraction_batch_and_stats.py has its own copy, prefetch_encoded();
+    the scripts run standalone, so fix both if either changes.)
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
-    # 1) Read the image
-    image = cv2.imread(image_path)
-    if image is None:
+
+# -----------------------------
+# 🔹 JPEG DECODE / ENCODE
+# -----------------------------
+def jpeg_exif_orientation(raw):
+    """
+    Returns the EXIF orientation tag (1-8) of in-memory JPEG bytes, or 1 if there is none.
+    Only the metadata segments before the image data are scanned.
+    """
+    data = memoryview(raw)
+    pos = 2
+    try:
+        while pos + 4 <= len(data) and data[pos] == 0xFF:
+            marker = data[pos + 1]
+            if marker in (0xD9, 0xDA):  # EOI / start of scan: no metadata after this
+                break
+            (segment_len,) = struct.unpack_from(">H", data, pos + 2)
+            if marker == 0xE1 and bytes(data[pos + 4:pos + 10]) == b"Exif\x00\x00":
+                tiff = bytes(data[pos + 10:pos + 2 + segment_len])
+                endian = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+                if endian is None:
+                    return 1
+                (ifd,) = struct.unpack_from(endian + "I", tiff, 4)
+                (count,) = struct.unpack_from(endian + "H", tiff, ifd)
+                for entry in range(ifd + 2, ifd + 2 + 12 * count, 12):
+                    (tag,) = struct.unpack_from(endian + "H", tiff, entry)
+                    if tag == 0x0112:
+                        (orientation,) = struct.unpack_from(endian + "H", tiff, entry + 8)
+                        return orientation if 1 <= orientation <= 8 else 1
+                return 1
+            pos += 2 + segment_len
+    except struct.error:
+        pass  # truncated/malformed metadata: treat as unrotated
+    return 1
+
+
+def decode_grayscale(raw, image_path):
+    """
+    Decodes in-memory image bytes to a single-channel grayscale array.
+    Real JPEGs (checked by magic bytes, not extension) are decoded by libjpeg-turbo
+    when it is available; anything else (e.g. PNG) goes through OpenCV. Both decode
+    straight to grayscale, so there is no separate BGR->gray pass.
+    TurboJPEG ignores EXIF orientation while cv2.imdecode applies it, so JPEGs with a
+    rotate/flip tag go through OpenCV too and come out the same either way.
+    """
+    if (
+        turbo_jpeg is not None
+        and bytes(raw[:3]) == JPEG_MAGIC
+        and jpeg_exif_orientation(raw) == 1
+    ):
+        try:
+            gray = turbo_jpeg.decode(raw, pixel_format=TJPF_GRAY)
+            return gray[:, :, 0]
+        except OSError:
+            pass  # let OpenCV try; it raises the path-bearing error below if it can't decode either
+
+    # cv2.imdecode asserts on an empty buffer; treat an empty file like any other unreadable image
+    gray = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_GRAYSCALE) if raw else None
+    if gray is None:
         raise ValueError(f"Could not read image: {image_path}")
+    return gray
+
 
-    # 2) Resize if needed
-    resized = resize_image(image)
+def encode_jpeg(gray, quality=JPEG_QUALITY):
+    """
+    Encodes a grayscale image to JPEG and returns the encoded buffer.
+    """
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(
+            gray, quality=quality, pixel_format=TJPF_GRAY, jpeg_subsample=TJSAMP_GRAY
+        )
+
+    success, buffer = cv2.imencode(".jpg", gray, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    if not success:
+        raise ValueError("Could not encode image to JPEG")
+    return buffer
+
+
+# -----------------------------
+# 🔹 SCRATCH BUFFER POOL
+# -----------------------------
+# Per-process, so each pool worker gets its own set
+_scratch_buffers = {}
+
+
+def scratch_buffer(name, shape):
+    """
+    Returns a uint8 array of the given 2-D shape backed by a per-process buffer
+    that is reused by every call with the same name.
+    The backing buffer only grows when a larger image comes along, so a batch of
+    similarly-sized images allocates it once. Its contents are overwritten by the
+    next call with that name.
+    """
+    size = shape[0] * shape[1]
+    backing = _scratch_buffers.get(name)
+    if backing is None or backing.size < size:
+        backing = np.empty(size, dtype=np.uint8)
+        _scratch_buffers[name] = backing
+    return backing[:size].reshape(shape)
 
-    # 3) Convert to grayscale
-    gray = cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY)
 
-    # 4) Compute threshold = mean(gray) - offset, clamped to [0..255]
-    mean_val = int(gray.mean())
+# -----------------------------
+# 🔹 IMAGE PREPROCESSING
+# -----------------------------
+def binarize(gray, offset, stride=MEAN_SAMPLE_STRIDE):
+    """
+    Binarizes a grayscale image at threshold = mean(gray) - offset.
+    The mean is estimated from every `stride`-th pixel along each axis,
+    which is plenty for a global threshold and touches 1/stride^2 of the bytes.
+    The result lives in the "binarized" scratch buffer.
+    """
+    bin_image = scratch_buffer("binarized", gray.shape)
+
+    mean_val = int(gray[::stride, ::stride].mean())
     threshold_val = max(0, min(255, mean_val - offset))
+    # cv2.threshold is a single SIMD pass; np.greater into a bool view plus *255 measured slower
+    cv2.threshold(gray, threshold_val, 255, cv2.THRESH_BINARY, dst=bin_image)
+    return bin_image
+
 
-    # 5) Binarize
-    _, bin_image = cv2.threshold(gray, threshold_val, 255, cv2.THRESH_BINARY)
+def preprocess_image(raw, image_path, offset):
+    """
+    1) Decodes the image bytes as grayscale
+    2) Resizes if necessary (max width = MAX_WIDTH)
+    3) Binarizes the image at threshold = (mean - offset)
+    4) Encodes the result to JPEG
+    5) Returns (jpeg_buffer, final_size_bytes, local_time).
+    """
+    start_local = time.perf_counter()
 
-    # Encode to memory buffer for size measurement
-    success, buffer = cv2.imencode(".jpg", bin_image, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
-    final_size_bytes = len(buffer) if success else 0
+    # 1) Decode the image
+    gray = decode_grayscale(raw, image_path)
+
+    # 2) Resize if needed; images already within MAX_WIDTH are used as-is.
+    #    The resized image lives in the "resized" scratch buffer.
+    h, w = gray.shape
+    if w > MAX_WIDTH:
+        new_h = h * MAX_WIDTH // w
+        gray = cv2.resize(
+            gray, (MAX_WIDTH, new_h), dst=scratch_buffer("resized", (new_h, MAX_WIDTH)),
+            interpolation=cv2.INTER_AREA
+        )
+
+    # 3) Binarize at threshold = mean(gray) - offset, clamped to [0..255]
+    bin_image = binarize(gray, offset)
+
+    # 4) Encode once; the same buffer is used for size measurement and saving.
+    #    The encoded copy is what leaves this function, so the scratch buffers are free again.
+    buffer = encode_jpeg(bin_image)
+    final_size_bytes = len(buffer)
 
     end_local = time.perf_counter()
     local_time = end_local - start_local
 
-    # Return the binarized image, final size, time
-    return bin_image, final_size_bytes, local_time
+    # Return the encoded image, final size, time
+    return buffer, final_size_bytes, local_time
+
+
+# --------------------------------
+# 🔹 WORKER: ONE IMAGE PER PROCESS
+# --------------------------------
+def _init_worker():
+    """
+    Pins OpenCV to a single thread inside each pool worker so the
+    processes don't oversubscribe the cores between them.
+    """
+    cv2.setNumThreads(1)
+
+
+def _load_task(task):
+    """
+    Runs on a reader thread: swaps the image path in a task for its file bytes.
+    Takes (image_path, offset, save_path) and returns
+    (image_path, raw, offset, save_path).
+    """
+    image_path, offset, save_path = task
+    return image_path, read_file(image_path), offset, save_path
+
+
+def _process_one(args):
+    """
+    Preprocesses a single image that has already been read into memory.
+    Takes (image_path, raw, offset, save_path) and returns
+    (image_file, save_path, original_size, jpeg_buffer, final_size_bytes, local_time).
+    Disk I/O stays on the parent's reader/writer threads.
+    """
+    image_path, raw, offset, save_path = args
+
+    # Preprocess (resize, binarize)
+    buffer, final_size_bytes, local_time = preprocess_image(raw, image_path, offset=offset)
+
+    return os.path.basename(image_path), save_path, len(raw), buffer, final_size_bytes, local_time
 
 
 # --------------------------------
@@ -105,38 +332,43 @@ def main():
 
     overall_start = time.perf_counter()
 
+    # Build one task per image, and record each output's id_type for the extraction step
+    tasks = []
+    manifest = {}
+    for image_file in all_images:
+        image_path = os.path.join(images_folder, image_file)
+
+        # Decide id_type and offset based on the (already lowercased) normalized filename
+        normalized_name = normalize_filename(image_file)
+        id_type, offset = classify_id(normalized_name)
+
+        out_filename = f"{normalized_name}_preprocessed.jpg"
+        save_path = os.path.join(preprocessed_folder, out_filename)
+        tasks.append((image_path, offset, save_path))
+        manifest[out_filename] = id_type
+
+    processes = min(os.cpu_count() or 1, len(tasks))
+
     # Open the results file
-    with open(results_file, "w") as results:
+    # Reader threads prefetch file bytes and writer threads save outputs,
+    # so the worker processes only ever decode, binarize and encode.
+    with open(results_file, "w") as results, \
+            ThreadPoolExecutor(max_workers=PREFETCH_DEPTH) as reader, \
+            ThreadPoolExecutor(max_workers=WRITER_THREADS) as writer, \
+            multiprocessing.Pool(processes=processes, initializer=_init_worker) as pool:
         results.write("=== IMAGE PREPROCESSING RESULTS ===\n\n")
 
-        for image_file in all_images:
-            image_path = os.path.join(images_folder, image_file)
-            original_size = os.path.getsize(image_path)
-
-            # Decide offset based on filename
-            # - license => mean - 20
-            # - passport => mean - 30
-            # - otherwise => offset = 0 (just use mean)
-            filename_lower = image_file.lower()
-            if filename_lower.startswith("license"):
-                offset = 20
-            elif filename_lower.startswith("passport"):
-                offset = 30
-            else:
-                offset = 0
-
-            # Preprocess (resize, binarize)
-            processed_image, final_size_bytes, local_time = preprocess_image(
-                image_path, offset=offset
-            )
+        loaded_tasks = prefetch(reader, _load_task, tasks, PREFETCH_DEPTH)
+        pending_writes = []
 
-            total_preprocess_time += local_time
+        # imap keeps results in task order, so the report stays sorted
+        for image_file, save_path, original_size, buffer, final_size_bytes, local_time in pool.imap(
+            _process_one, loaded_tasks
+        ):
+            # Save final result without blocking on the write
+            pending_writes.append(writer.submit(write_file, save_path, buffer))
 
-            # Save final result
-            normalized_name = normalize_filename(image_file)
-            out_filename = f"{normalized_name}_preprocessed.jpg"
-            save_path = os.path.join(preprocessed_folder, out_filename)
-            cv2.imwrite(save_path, processed_image, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+            total_preprocess_time += local_time
 
             # Update stats
             combined_original_size += original_size
@@ -150,6 +382,15 @@ def main():
             results.write(f"  - Processing time: {local_time * 1000:.2f} ms\n")
             results.write("\n")
 
+        # Surface any write errors before reporting
+        for write in pending_writes:
+            write.result()
+
+        manifest_file = os.path.join(preprocessed_folder, MANIFEST_FILENAME)
+        with open(manifest_file, "w") as manifest_f:
+            json.dump(manifest, manifest_f, indent=4, sort_keys=True)
+            manifest_f.write("\n")
+
         overall_end = time.perf_counter()
         total_runtime = overall_end - overall_start
 
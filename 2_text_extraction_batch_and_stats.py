@@ -1,10 +1,15 @@
 import os
 import json
 import base64
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
 import requests
 from dotenv import load_dotenv
 import re
 import time  # for timing
+import zlib
 
 # Load environment variables
 load_dotenv()
@@ -14,6 +19,9 @@ FIREWORKS_API_KEY = os.getenv("FIREWORKS_API_KEY")
 FIREWORKS_ENDPOINT = os.getenv("FIREWORKS_ENDPOINT")
 FIREWORKS_MODEL = os.getenv("FIREWORKS_MODEL")
 
+# Opt-in: gzip the request body (Content-Encoding: gzip); leave off if the endpoint rejects it
+FIREWORKS_GZIP_REQUESTS = os.getenv("FIREWORKS_GZIP_REQUESTS", "").lower() in ("1", "true", "yes")
+
 print(f"Loaded Endpoint: {FIREWORKS_ENDPOINT}")
 print(f"Loaded Model: {FIREWORKS_MODEL}")
 
@@ -21,6 +29,119 @@ print(f"Loaded Model: {FIREWORKS_MODEL}")
 if not FIREWORKS_API_KEY or not FIREWORKS_ENDPOINT:
     raise ValueError("Missing Fireworks API credentials in environment variables.")
 
+
+# Images are read, shrunk and base64-encoded on this many threads, at most this many ahead of the upload
+ENCODE_THREADS = 8
+
+# Images are shrunk to fit this long edge and re-encoded at this JPEG quality before upload;
+# the model's vision encoder downsamples anyway, so the extra pixels only cost bytes and tokens
+API_MAX_EDGE = 1536
+API_JPEG_QUALITY = 75
+
+# Matches everything except digits; used to clean up passport numbers
+NON_DIGIT_RE = re.compile(r"\D")
+
+
+def shrink_for_api(raw, image_path):
+    """
+    Downsizes an image so its long edge fits API_MAX_EDGE and re-encodes it as a
+    JPEG at API_JPEG_QUALITY. Returns whichever of that and the original bytes is
+    smaller, unless the image had to be resized.
+    """
+    # Preprocessed images are single-channel, so decode them that way
+    gray = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError(f"Could not read image: {image_path}")
+
+    h, w = gray.shape
+    long_edge = max(h, w)
+    resized = long_edge > API_MAX_EDGE
+    if resized:
+        scale = API_MAX_EDGE / long_edge
+        gray = cv2.resize(gray, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+    success, buffer = cv2.imencode(".jpg", gray, [int(cv2.IMWRITE_JPEG_QUALITY), API_JPEG_QUALITY])
+    if not success:
+        raise ValueError(f"Could not encode image: {image_path}")
+
+    if not resized and len(buffer) >= len(raw):
+        return raw
+    return buffer
+
+
+def read_and_b64(image_path):
+    """
+    Reads an image file, shrinks it for the API and base64-encodes it.
+    Returns (encoded_bytes, seconds spent on this image).
+    """
+    start_encode = time.perf_counter()
+    with open(image_path, "rb") as img_f:
+        encoded = base64.b64encode(shrink_for_api(img_f.read(), image_path))
+    return encoded, time.perf_counter() - start_encode
+
+
+def image_block_json(encoded):
+    """
+    Serializes an image_url content block around base64-encoded JPEG bytes.
+    Base64 output is plain ASCII, so it goes into the JSON string as-is.
+    """
+    return b'{"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,' + encoded + b'"}}'
+
+
+def prefetch_encoded(executor, image_paths):
+    """
+    Yields read_and_b64(path) for each image path, in order, while keeping up to
+    ENCODE_THREADS images encoding ahead on the executor, so at most that many
+    encoded images wait in memory for the upload.
+    (Same ordered-window pattern as prefetch() in 1_cv2_preprocess_and_stats.py;
+    the scripts run standalone, so fix both if either changes.)
+    """
+    pending = collections.deque()
+    for image_path in image_paths:
+        pending.append(executor.submit(read_and_b64, image_path))
+        if len(pending) >= ENCODE_THREADS:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def gzip_stream(chunks):
+    """
+    Gzip-compresses an iterable of bytes chunks on the fly, yielding compressed chunks.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_request_body(params, content, executor, encode_times):
+    """
+    Yields the chat request (params plus one user message) as JSON bytes chunks.
+    `content` holds dict blocks, which are serialized here, or image paths, which
+    are read and base64-encoded on the executor a few images ahead of the upload,
+    so only that window of image data is held in memory at a time.
+    The time spent encoding each image is appended to `encode_times`.
+    """
+    image_paths = [block for block in content if isinstance(block, str)]
+    encoded_images = prefetch_encoded(executor, image_paths)
+
+    yield json.dumps(params)[:-1].encode("utf-8")
+    yield b', "messages": [{"role": "user", "content": ['
+    for i, block in enumerate(content):
+        if i:
+            yield b", "
+        if isinstance(block, dict):
+            yield json.dumps(block).encode("utf-8")
+        else:
+            encoded, encode_time = next(encoded_images)
+            encode_times.append(encode_time)
+            yield image_block_json(encoded)
+    yield b"]}]}"
+
+
 images_folder = "preprocessed_images"
 results_folder = "results"
 os.makedirs(results_folder, exist_ok=True)  # Ensure results folder exists
@@ -31,7 +152,16 @@ image_files = [f for f in os.listdir(images_folder) if f.lower().endswith(("png"
 if not image_files:
     raise FileNotFoundError("No images found in the 'preprocessed_images' folder.")
 
-# 1. Read all images and build a single "user" content array
+# id_type for each preprocessed image, as decided by 1_cv2_preprocess_and_stats.py
+manifest_file = os.path.join(images_folder, "manifest.json")
+if not os.path.exists(manifest_file):
+    raise FileNotFoundError(
+        "No manifest.json found in the 'preprocessed_images' folder. Run 1_cv2_preprocess_and_stats.py first."
+    )
+with open(manifest_file) as manifest_f:
+    id_types = json.load(manifest_f)
+
+# 1. Build a single "user" content array for all images
 batch_content = []
 instructions_text = (
     "We have multiple ID images. For each image, extract all text in an organized way. "
@@ -72,25 +202,18 @@ batch_content.append({
 
 # For each image, insert it into the prompt
 for image_file in image_files:
-    # Detect id_type from the filename
-    if image_file.lower().startswith("license"):
-        id_type = "drivers_license"
-    elif image_file.lower().startswith("passport"):
-        id_type = "passport"
-    else:
+    # Look up id_type from the preprocessing manifest
+    id_type = id_types.get(image_file)
+    if id_type is None:
+        # Stale output from an earlier run, or a file added by hand
+        print(f"Warning: {image_file} is not listed in {manifest_file}; sending id_type N/A. "
+              f"Re-run 1_cv2_preprocess_and_stats.py to classify it.")
         id_type = "N/A"
 
     image_path = os.path.join(images_folder, image_file)
-    with open(image_path, "rb") as img_f:
-        encoded = base64.b64encode(img_f.read()).decode("utf-8")
-    
-    # Add an image block
-    batch_content.append({
-        "type": "image_url",
-        "image_url": {
-            "url": f"data:image/jpeg;base64,{encoded}"
-        }
-    })
+
+    # Add an image block (just the path; it is read and encoded while the request is sent)
+    batch_content.append(image_path)
     # Add a short text prompt referencing the specific file and ID type
     batch_content.append({
         "type": "text",
@@ -100,32 +223,37 @@ for image_file in image_files:
         )
     })
 
-# 2. Create a single messages list for the conversation
-messages = [
-    {
-        "role": "user",
-        "content": batch_content
-    }
-]
-
-# 3. Prepare the overall payload
-payload = {
+# 2. Prepare the request parameters
+params = {
     "model": FIREWORKS_MODEL,
     "max_tokens": 4096,
     "top_p": 1,
     "top_k": 100,
     "presence_penalty": 0,
     "frequency_penalty": 0,
-    "temperature": 0,
-    "messages": messages
+    "temperature": 0
 }
 
+# 3. Serialize the payload, with batch_content as the single user message.
+#    This is a generator, so requests streams it with Transfer-Encoding: chunked,
+#    while the encoder threads prepare the next images.
+encoder = ThreadPoolExecutor(max_workers=ENCODE_THREADS)
+encode_times = []
+payload_body = stream_request_body(params, batch_content, encoder, encode_times)
+
 headers = {
     "Accept": "application/json",
     "Content-Type": "application/json",
     "Authorization": f"Bearer {FIREWORKS_API_KEY}"
 }
 
+if FIREWORKS_GZIP_REQUESTS:
+    headers["Content-Encoding"] = "gzip"
+    payload_body = gzip_stream(payload_body)
+
+# A Session keeps the connection alive; reused if more calls are added
+session = requests.Session()
+
 # Record start time (for performance measurement)
 start_time = time.time()
 
@@ -133,14 +261,18 @@ start_time = time.time()
 total_api_calls = 1
 
 # Send the request
-response = requests.post(FIREWORKS_ENDPOINT, headers=headers, data=json.dumps(payload))
+with encoder, session:
+    response = session.post(FIREWORKS_ENDPOINT, headers=headers, data=payload_body)
 
 # Record end time
 end_time = time.time()
 
-# Calculate duration in milliseconds
+# Calculate duration in milliseconds.
+# The body is built while it is sent, so this window also covers the client-side
+# image encoding; that part is summed separately (across encoder threads) below.
 duration_ms = (end_time - start_time) * 1000
 average_ms_per_image = duration_ms / len(image_files)
+encode_ms = sum(encode_times) * 1000
 
 # Open results file to store extracted text
 with open(results_file, "w") as results:
@@ -173,7 +305,7 @@ with open(results_file, "w") as results:
                         if item.get("id_type") == "passport":
                             original_id = item.get("id_number", "")
                             # Extract only digits
-                            digits_only = "".join(ch for ch in original_id if ch.isdigit())
+                            digits_only = NON_DIGIT_RE.sub("", original_id)
                             # Keep only first 9
                             item["id_number"] = digits_only[:9]
 
@@ -195,8 +327,9 @@ with open(results_file, "w") as results:
             results.write("\n--- Performance & Design Statistics ---\n")
             results.write(f"Number of images processed: {len(image_files)}\n")
             results.write(f"Total number of API calls: {total_api_calls}\n")
-            results.write(f"Total time for request: {duration_ms:.2f} ms\n")
-            results.write(f"Average time per image: {average_ms_per_image:.2f} ms\n")
+            results.write(f"Total time for request (incl. image encoding): {duration_ms:.2f} ms\n")
+            results.write(f"Average time per image (incl. image encoding): {average_ms_per_image:.2f} ms\n")
+            results.write(f"Client-side image encoding time (summed over encoder threads): {encode_ms:.2f} ms\n")
 
             # Write token statistics
             results.write("\n--- Usage / Token Statistics ---\n")
@@ -226,8 +359,9 @@ with open(results_file, "w") as results:
 print("\n--- Performance & Design Statistics ---")
 print(f"Number of images processed: {len(image_files)}")
 print(f"Total number of API calls: {total_api_calls}")
-print(f"Total time for request: {duration_ms:.2f} ms")
-print(f"Average time per image: {average_ms_per_image:.2f} ms\n")
+print(f"Total time for request (incl. image encoding): {duration_ms:.2f} ms")
+print(f"Average time per image (incl. image encoding): {average_ms_per_image:.2f} ms")
+print(f"Client-side image encoding time (summed over encoder threads): {encode_ms:.2f} ms\n")
 
 print("Usage / Token Statistics:")
 print(f"  Prompt tokens: {prompt_tokens}")